@@ -1,20 +1,38 @@
+import hashlib
+import io
 import streamlit as st
+import streamlit.components.v1 as components
 import leafmap.foliumap as leafmap
 import geopandas as gpd
-from shapely.geometry import Polygon, MultiPolygon
+from shapely import wkb
+from shapely.geometry import Polygon, MultiPolygon, mapping
+from shapely.ops import unary_union
 import folium
-from dem_utils import process_slope
+from folium.plugins import Draw
+from dem_utils import process_slope, warm_up, SLOPE_LEGEND_HTML
 
 
 st.set_page_config(page_title="Slope Analysis", layout="wide")
 st.title("Slope Analysis Tool")
 
+# AOIs are areas: only polygon/rectangle drawing makes sense
+DRAW_OPTS = dict(
+    polygon=True,
+    rectangle=True,
+    polyline=False,
+    circle=False,
+    marker=False,
+    circlemarker=False,
+)
+EDIT_OPTS = dict(edit=True, remove=True)
+
 
 # ---------------------------------------------------------
-# Load only polygon layer from KML
+# Load only polygon layer from KML (parsed once per file, not per rerun)
 # ---------------------------------------------------------
-def load_polygon_from_kml(file):
-    gdf = gpd.read_file(file)
+@st.cache_data(show_spinner=False, max_entries=32)
+def parse_kml(data):
+    gdf = gpd.read_file(io.BytesIO(data), driver="KML")
 
     # Keep only polygons/multipolygons
     poly_gdf = gdf[gdf.geometry.apply(
@@ -22,104 +40,149 @@ def load_polygon_from_kml(file):
     )]
 
     if poly_gdf.empty:
-        st.error("❌ This KML has no polygon boundaries. It contains only points/lines.")
         return None
 
+    # Single polygon (the usual case): nothing to merge
+    if len(poly_gdf) == 1:
+        return poly_gdf.geometry.iloc[0]
+
     # Merge all polygon pieces into one
-    merged = poly_gdf.unary_union
+    return unary_union(list(poly_gdf.geometry))
+
+
+def load_polygon_from_kml(file):
+    geom = parse_kml(file.getvalue())
+
+    if geom is None:
+        st.error("❌ This KML has no polygon boundaries. It contains only points/lines.")
+
+    return geom
+
+
+# ---------------------------------------------------------
+# Cached slope processing (keyed on geometry WKB)
+# ---------------------------------------------------------
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def _slope_cached(wkb_bytes, tolerance):
+    return process_slope(wkb.loads(wkb_bytes), tolerance)
+
+
+# ---------------------------------------------------------
+# Compile the slope kernel once per server process, not on first click
+# ---------------------------------------------------------
+@st.cache_resource(show_spinner=False)
+def _warm_up():
+    warm_up()
+
 
-    return merged
+_warm_up()
+
+
+# ---------------------------------------------------------
+# AOI draw map: built and rendered once per server process
+# ---------------------------------------------------------
+@st.cache_resource(show_spinner=False)
+def _draw_map():
+    m = leafmap.Map()
+    Draw(draw_options=DRAW_OPTS, edit_options=EDIT_OPTS).add_to(m)
+    m.add_layer_control()
+    return m, m.to_html()
 
 
 # ---------------------------------------------------------
 # INPUT SECTION
 # ---------------------------------------------------------
-uploaded = st.file_uploader("Upload KML", type=["kml"])
+# Uploading only takes effect on submit, so picking a file doesn't rerun
+with st.form("slope_form"):
+    uploaded = st.file_uploader("Upload KML", type=["kml"])
+    submitted = st.form_submit_button("Generate Slope Map")
+
 draw_mode = st.checkbox("Or draw AOI manually", value=False)
+tolerance = st.sidebar.slider(
+    "AOI simplify tolerance (°)",
+    min_value=0.0,
+    max_value=1e-4,
+    value=1e-5,
+    step=1e-6,
+    format="%.6f",
+    help="Vertices closer than this to a straight edge are dropped. 0 keeps the boundary as-is.",
+)
 
 geom = None
+source_hash = None
 
 # Load uploaded polygon KML
 if uploaded:
+    source_hash = hashlib.md5(uploaded.getvalue()).hexdigest()
     geom = load_polygon_from_kml(uploaded)
 
 # Draw AOI manually
 if draw_mode:
-    m = leafmap.Map(draw_control=True)
-    m.to_streamlit(height=450)
+    m, draw_html = _draw_map()
+    components.html(draw_html, height=450)
 
     if m.user_roi_bounds() is not None:
         geom = m.user_roi_as_geometry()
+        source_hash = hashlib.md5(geom.wkb).hexdigest()
 
 
 # ---------------------------------------------------------
 # GENERATE SLOPE MAP
 # ---------------------------------------------------------
-if geom is not None and st.button("Generate Slope Map"):
+if submitted and geom is None:
+    st.warning("Upload a KML or draw an AOI first.")
+
+if submitted and geom is not None:
+
+    try:
+        with st.spinner("Downloading DEM and computing slope..."):
+            result = _slope_cached(geom.wkb, tolerance)
+    except (ValueError, RuntimeError) as e:
+        # Exceptions are not cached, so the next click retries
+        st.error(str(e))
+    else:
+        st.success("Slope map created.")
+        st.session_state["slope_result"] = result
+        st.session_state["slope_key"] = (source_hash, tolerance)
 
-    result = process_slope(geom)
 
-    if result:
-        st.success("Slope map created.")
+# ---------------------------------------------------------
+# SHOW SLOPE MAP (kept across reruns while the AOI is unchanged)
+# ---------------------------------------------------------
+if geom is not None and st.session_state.get("slope_key") == (source_hash, tolerance):
+
+    result = st.session_state["slope_result"]
+
+    # Rebuilding the folium HTML (with the embedded PNG) is the slow part of a
+    # rerun, so only do it when the result itself changed
+    map_key = st.session_state["slope_key"]
+    if st.session_state.get("map_key") != map_key:
 
         centroid = [geom.centroid.y, geom.centroid.x]
         m2 = leafmap.Map(center=centroid, zoom=13)
         m2.add_basemap("HYBRID")
 
-        # Correct bounds
-        min_lat, min_lon = result["bounds"][0]
-        max_lat, max_lon = result["bounds"][1]
-
-        if min_lat > max_lat:
-            min_lat, max_lat = max_lat, min_lat
-        if min_lon > max_lon:
-            min_lon, max_lon = max_lon, min_lon
+        # Slope overlay + AOI outline share one layer, serialized once
+        slope_layer = folium.FeatureGroup(name="Slope")
 
-        bounds = [[min_lat, min_lon], [max_lat, max_lon]]
-
-        # Add slope raster overlay
         folium.raster_layers.ImageOverlay(
             image=result["data_url"],
-            bounds=bounds,
+            bounds=result["bounds"],
             opacity=1.0,
             interactive=True,
             cross_origin=False,
-        ).add_to(m2)
-
-        # Add AOI boundary
-        gdf = gpd.GeoDataFrame(geometry=[geom], crs="EPSG:4326")
-        m2.add_gdf(gdf, layer_name="AOI")
-
-        # -----------------------------
-        # LEGEND
-        # -----------------------------
-        legend_html = """
-        <div style="
-            position: fixed;
-            bottom: 25px;
-            left: 25px;
-            z-index: 9999;
-            background-color: white;
-            padding: 10px 15px;
-            border: 2px solid #444;
-            border-radius: 8px;
-            box-shadow: 2px 2px 5px rgba(0,0,0,0.3);
-            max-width: 180px;
-            font-size: 14px;
-        ">
-        <b>Slope Classes (°)</b><br>
-        <div style="display:flex;align-items:center;"><div style="width:18px;height:18px;background:#ADD8E6;"></div>&nbsp;0–8°</div>
-        <div style="display:flex;align-items:center;"><div style="width:18px;height:18px;background:#90EE90;"></div>&nbsp;8–16°</div>
-        <div style="display:flex;align-items:center;"><div style="width:18px;height:18px;background:#006400;"></div>&nbsp;16–24°</div>
-        <div style="display:flex;align-items:center;"><div style="width:18px;height:18px;background:#FFFF66;"></div>&nbsp;24–32°</div>
-        <div style="display:flex;align-items:center;"><div style="width:18px;height:18px;background:#FFA500;"></div>&nbsp;32–40°</div>
-        <div style="display:flex;align-items:center;"><div style="width:18px;height:18px;background:#FF0000;"></div>&nbsp;40–48°</div>
-        <div style="display:flex;align-items:center;"><div style="width:18px;height:18px;background:#8B0000;"></div>&nbsp;48–56°</div>
-        <div style="display:flex;align-items:center;"><div style="width:18px;height:18px;background:#800080;"></div>&nbsp;56–64°</div>
-        <div style="display:flex;align-items:center;"><div style="width:18px;height:18px;background:#000;"></div>&nbsp;>64°</div>
-        </div>
-        """
-        m2.get_root().html.add_child(folium.Element(legend_html))
-
-        # Display map
-        m2.to_streamlit(height=650)
+        ).add_to(slope_layer)
+
+        folium.GeoJson(data=mapping(geom), name="AOI").add_to(slope_layer)
+
+        slope_layer.add_to(m2)
+
+        # Legend (static HTML, built once in dem_utils)
+        m2.get_root().html.add_child(folium.Element(SLOPE_LEGEND_HTML))
+
+        m2.add_layer_control()
+        st.session_state["map_html"] = m2.to_html()
+        st.session_state["map_key"] = map_key
+
+    # Display map
+    components.html(st.session_state["map_html"], height=650)
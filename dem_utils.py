@@ -1,65 +1,273 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import rasterio
 import numpy as np
-from rasterio.mask import mask
-from shapely.geometry import mapping, Polygon
+from rasterio.features import geometry_mask
+from rasterio.transform import array_bounds
+from rasterio.windows import Window, from_bounds
+from shapely.geometry import box, mapping, Polygon
+from shapely.prepared import prep
 from shapely.validation import make_valid
 from shapely.ops import unary_union
 from PIL import Image
 import streamlit as st
 import base64
+import hashlib
+import math
+import os
+import tempfile
+import threading
+import time
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from shapely import get_coordinates, wkb
+
+try:
+    from numba import njit, prange
+except ImportError:  # NumPy-only fallback (tiled path below)
+    njit = None
+
+
+# ---------------------------------------------------------
+# Slope class colours (RGBA), one row per 8° class
+# ---------------------------------------------------------
+SLOPE_LUT = np.array([
+    (173, 216, 230, 255),  # 0 light blue
+    (144, 238, 144, 255),  # 1 light green
+    (0, 100, 0, 255),      # 2 dark green
+    (255, 255, 102, 255),  # 3 yellow
+    (255, 165, 0, 255),    # 4 orange
+    (255, 0, 0, 255),      # 5 red
+    (139, 0, 0, 255),      # 6 dark red
+    (128, 0, 128, 255),    # 7 purple
+    (0, 0, 0, 255),        # 8 black
+], dtype=np.uint8)
+
+# (label, hex colour) per class, for map legends
+SLOPE_LEGEND = [
+    (
+        f"{8 * i}–{8 * (i + 1)}°" if i < len(SLOPE_LUT) - 1 else f">{8 * i}°",
+        "#{:02X}{:02X}{:02X}".format(*rgba[:3]),
+    )
+    for i, rgba in enumerate(SLOPE_LUT)
+]
+
+# Map legend; static, so built once at import
+SLOPE_LEGEND_HTML = """
+<div style="
+    position: fixed;
+    bottom: 25px;
+    left: 25px;
+    z-index: 9999;
+    background-color: white;
+    padding: 10px 15px;
+    border: 2px solid #444;
+    border-radius: 8px;
+    box-shadow: 2px 2px 5px rgba(0,0,0,0.3);
+    max-width: 180px;
+    font-size: 14px;
+">
+<b>Slope Classes (°)</b><br>
+{rows}
+</div>
+""".format(rows="\n".join(
+    f'<div style="display:flex;align-items:center;">'
+    f'<div style="width:18px;height:18px;background:{color};"></div>'
+    f'&nbsp;{label}</div>'
+    for label, color in SLOPE_LEGEND
+))
+
+# Class edges on the squared gradient: tan²(8°·k), k = 1..8.
+# slope >= 8k°  <=>  dx² + dy² >= tan²(8k°), so no arctan/sqrt is needed
+SLOPE_THRESH2 = (np.tan(np.radians(8.0 * np.arange(1, 9))) ** 2).astype(np.float32)
+
+# Rasters above this size are processed in tiles to bound temporaries
+MAX_UNTILED_PIXELS = 40_000_000
+TILE_SIZE = 2048
+
+# DEM read tile (multiple of the usual 256-px GeoTIFF block)
+READ_TILE = 512
+
+# Longest side of the PNG sent to the browser
+PREVIEW_MAX_SIDE = 2048
+
+# Downloaded DEMs, one GeoTIFF per (rounded) bbox; survives app restarts
+DEM_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dem_cache")
+DEM_CACHE_MAX_FILES = 64
+DEM_CACHE_MAX_BYTES = 1 << 30
+
+# Part files older than this belong to a crashed download, not a live one
+PART_MAX_AGE_S = 3600
+
+# Shared HTTP session: keeps connections alive across retries and mirrors;
+# urllib3 retries connection errors and 5xx with exponential backoff
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]),
+))
 
 
 # ---------------------------------------------------------
 # Fix polygon
 # ---------------------------------------------------------
-def clean_geometry(geom):
+def clean_geometry(geom, tolerance=1e-5):
     if geom is None:
         return None
 
+    # Reruns hand us the same AOI again; skip make_valid/simplify for it
+    return _clean_by_wkb(geom.wkb, tolerance)
+
+
+@lru_cache(maxsize=32)
+def _clean_by_wkb(wkb_bytes, tolerance):
+    geom = wkb.loads(wkb_bytes)
+
     if not geom.is_valid:
         geom = make_valid(geom)
 
     if geom.geom_type == "GeometryCollection":
-        polys = [g for g in geom if g.geom_type == "Polygon"]
+        polys = [g for g in geom.geoms if g.geom_type in ("Polygon", "MultiPolygon")]
         if not polys:
             return None
         geom = unary_union(polys)
 
+    # make_valid can collapse a degenerate ring to a line or point
+    if geom.is_empty or geom.geom_type not in ("Polygon", "MultiPolygon"):
+        return None
+
     if geom.geom_type == "Polygon":
-        coords = list(geom.exterior.coords)
-        if coords[0] != coords[-1]:
-            coords.append(coords[0])
-        geom = Polygon(coords)
+        coords = get_coordinates(geom.exterior)
+        # Rebuild only for an open ring, and keep any holes
+        if not np.array_equal(coords[0], coords[-1]):
+            geom = Polygon(np.vstack([coords, coords[:1]]), geom.interiors)
+
+    # Drop near-collinear vertices (1e-5° ~ 1 m) before masking
+    if tolerance > 0:
+        if geom.geom_type == "MultiPolygon":
+            geom = unary_union([_simplify(g, tolerance) for g in geom.geoms])
+        else:
+            geom = _simplify(geom, tolerance)
 
     return geom
 
 
+def _simplify(geom, tolerance):
+    # Plain Douglas-Peucker is ~10x faster; fall back if it breaks the shape
+    fast = geom.simplify(tolerance, preserve_topology=False)
+    if fast.is_empty or not fast.is_valid:
+        return geom.simplify(tolerance, preserve_topology=True)
+    return fast
+
+
 # ---------------------------------------------------------
 # Safe bounding box
 # ---------------------------------------------------------
-def safe_bbox(geom):
+def safe_bbox(geom, decimals=4):
     minx, miny, maxx, maxy = geom.bounds
+    # Round outward (~11 m at 4 decimals) so near-identical AOIs share a DEM
+    scale = 10 ** decimals
     return (
-        min(minx, maxx),  # west
-        min(miny, maxy),  # south
-        max(minx, maxx),  # east
-        max(miny, maxy),  # north
+        math.floor(min(minx, maxx) * scale) / scale,  # west
+        math.floor(min(miny, maxy) * scale) / scale,  # south
+        math.ceil(max(minx, maxx) * scale) / scale,   # east
+        math.ceil(max(miny, maxy) * scale) / scale,   # north
     )
 
 
 # ---------------------------------------------------------
 # DEM DOWNLOAD
 # ---------------------------------------------------------
-def download_dem(bbox, out_path="dem.tif"):
-    if "OPENTOPO_API_KEY" not in st.secrets:
-        st.error("Missing OPENTOPO_API_KEY in Streamlit secrets.")
+def _discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _fetch_to_file(url, part_dir, cancel):
+    # Stream to disk in 1 MB chunks; None on non-200 or if another mirror won.
+    # Each download gets its own part file, so sessions fetching the same
+    # bbox never write into each other's file
+    with _SESSION.get(url, stream=True, timeout=(5, 30)) as r:
+        if r.status_code != 200:
+            return None
+
+        fd, part_path = tempfile.mkstemp(dir=part_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1 << 20):
+                    if cancel.is_set():
+                        break
+                    f.write(chunk)
+        except Exception:
+            # Never leave a truncated download behind
+            _discard(part_path)
+            raise
+
+    if cancel.is_set():
+        _discard(part_path)
         return None
+    return part_path
+
+
+def _discard_result(fut):
+    # Done-callback for losing mirrors: drop a part file nobody will rename
+    if not fut.cancelled() and fut.exception() is None and fut.result():
+        _discard(fut.result())
+
+
+def _prune_dem_cache():
+    # Evict least-recently-used DEMs before a download; the incoming file's
+    # size is unknown, so the byte cap can be overshot by that one DEM
+    now = time.time()
+    tifs = []
+    for entry in os.scandir(DEM_CACHE_DIR):
+        try:
+            info = entry.stat()
+        except FileNotFoundError:  # removed by a concurrent session
+            continue
+        if entry.name.endswith(".part"):
+            if now - info.st_mtime > PART_MAX_AGE_S:
+                _discard(entry.path)
+        elif entry.name.endswith(".tif"):
+            tifs.append((info.st_mtime, info.st_size, entry.path))
+
+    tifs.sort()
+    total = sum(size for _, size, _ in tifs)
+    while tifs and (len(tifs) >= DEM_CACHE_MAX_FILES or total > DEM_CACHE_MAX_BYTES):
+        _, size, path = tifs.pop(0)
+        _discard(path)
+        total -= size
+
+
+# Not st.cache_data: the file check below is the cache, and a memoized path
+# could outlive an evicted file
+def download_dem(bbox):
+    if "OPENTOPO_API_KEY" not in st.secrets:
+        raise RuntimeError("Missing OPENTOPO_API_KEY in Streamlit secrets.")
 
     api_key = st.secrets["OPENTOPO_API_KEY"]
     west, south, east, north = bbox
 
+    # One file per bbox; it only ever appears via an atomic rename
+    key = hashlib.sha1(f"{west}_{south}_{east}_{north}".encode()).hexdigest()
+    os.makedirs(DEM_CACHE_DIR, exist_ok=True)
+    out_path = os.path.join(DEM_CACHE_DIR, f"{key}.tif")
+
+    # Only complete files are ever renamed into place, so a hit is whole;
+    # touching it marks it as recently used for eviction
+    try:
+        os.utime(out_path)
+        return out_path
+    except FileNotFoundError:
+        pass
+
+    _prune_dem_cache()
+
     urls = [
         f"https://portal.opentopography.org/API/globaldem?demtype=SRTMGL1"
         f"&south={south}&north={north}&west={west}&east={east}"
@@ -70,101 +278,347 @@ def download_dem(bbox, out_path="dem.tif"):
         f"&outputFormat=GTiff&API_Key={api_key}",
     ]
 
-    for attempt in range(1, 6):
-        for url in urls:
+    # Race primary and mirror; retries happen inside the session
+    cancel = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=len(urls))
+    futures = [pool.submit(_fetch_to_file, url, DEM_CACHE_DIR, cancel) for url in urls]
+    winner = None
+    try:
+        for fut in as_completed(futures):
             try:
-                st.write(f"DEM attempt {attempt}: {url}")
-                r = requests.get(url, timeout=15)
-                if r.status_code == 200:
-                    with open(out_path, "wb") as f:
-                        f.write(r.content)
-                    return out_path
-            except Exception as e:
-                st.write(f"Failed: {e}")
+                part_path = fut.result()
+            except requests.RequestException:
+                continue
+            except OSError as e:  # e.g. disk full
+                raise RuntimeError(f"DEM download failed: {e}") from e
+            if part_path is not None:
+                winner = fut
+                cancel.set()
+                try:
+                    os.replace(part_path, out_path)
+                except OSError as e:
+                    _discard(part_path)
+                    # Another session finished the same bbox first
+                    if not os.path.exists(out_path):
+                        raise RuntimeError(f"DEM download failed: {e}") from e
+                return out_path
+    finally:
+        cancel.set()
+        # Runs now for finished losers, or when a still-running one returns
+        for fut in futures:
+            if fut is not winner:
+                fut.add_done_callback(_discard_result)
+        pool.shutdown(wait=False)
+
+    raise RuntimeError("DEM download failed.")
+
+
+# ---------------------------------------------------------
+# AOI pixel window + the same window snapped out to GeoTIFF blocks
+# ---------------------------------------------------------
+def aoi_windows(src, bounds):
+    win = from_bounds(*bounds, transform=src.transform)
+    row0, col0 = int(np.floor(win.row_off)), int(np.floor(win.col_off))
+    row1 = int(np.ceil(win.row_off + win.height))
+    col1 = int(np.ceil(win.col_off + win.width))
+
+    row0, col0 = max(row0, 0), max(col0, 0)
+    row1, col1 = min(row1, src.height), min(col1, src.width)
+    aoi = Window(col0, row0, col1 - col0, row1 - row0)
+
+    # GDAL decodes whole blocks anyway, so read exactly those
+    bh, bw = src.block_shapes[0]
+    brow0, bcol0 = row0 - row0 % bh, col0 - col0 % bw
+    brow1 = min(-(-row1 // bh) * bh, src.height)
+    bcol1 = min(-(-col1 // bw) * bw, src.width)
+    aligned = Window(bcol0, brow0, bcol1 - bcol0, brow1 - brow0)
+
+    return aoi, aligned
+
+
+# ---------------------------------------------------------
+# Horn gradient (3x3 kernel), squared magnitude scaled by (8 * ewres)²
+# ---------------------------------------------------------
+def horn_gradient2(dem, ewres, nsres):
+    arr = np.pad(dem.astype(np.float32, copy=False), 1, mode="edge")
+
+    a, b, c = arr[:-2, :-2], arr[:-2, 1:-1], arr[:-2, 2:]
+    d, f = arr[1:-1, :-2], arr[1:-1, 2:]
+    g, h, i = arr[2:, :-2], arr[2:, 1:-1], arr[2:, 2:]
+
+    # Two buffers, filled in place: (c + 2f + i) - (a + 2d + g), etc.
+    dx = np.add(f, f)
+    dx += c
+    dx += i
+    dx -= a
+    dx -= d
+    dx -= d
+    dx -= g
+
+    dy = np.add(h, h)
+    dy += g
+    dy += i
+    dy -= a
+    dy -= b
+    dy -= b
+    dy -= c
+
+    # 1 / (8 * ewres) is folded into the thresholds; only the ratio is left
+    dy *= ewres / nsres
+
+    dx *= dx
+    dy *= dy
+    dx += dy
+    return dx
 
-        st.write("Retrying...")
 
-    st.error("DEM download failed.")
-    return None
+def classify_gradient2(mag2, thresh2):
+    return np.searchsorted(thresh2, mag2, side="right").astype(np.uint8)
+
+
+# ---------------------------------------------------------
+# Fused Horn slope + 8° classification (Numba, one pass, no temporaries)
+# ---------------------------------------------------------
+if njit is not None:
+    # Eager signature: compiled (or loaded from cache) at import time
+    @njit(
+        "void(float32[:, ::1], float64, float32[::1], uint8[:, ::1])",
+        parallel=True, fastmath=True, cache=True,
+    )
+    def _horn_classes(dem, ratio, thresh2, out):
+        h, w = dem.shape
+
+        for r in prange(h):
+            # Clamped neighbours == edge padding
+            rn, rs = max(r - 1, 0), min(r + 1, h - 1)
+            for c in range(w):
+                cw, ce = max(c - 1, 0), min(c + 1, w - 1)
+
+                a, b, c_ = dem[rn, cw], dem[rn, c], dem[rn, ce]
+                d, f = dem[r, cw], dem[r, ce]
+                g, h_, i = dem[rs, cw], dem[rs, c], dem[rs, ce]
+
+                dx = (c_ + 2 * f + i) - (a + 2 * d + g)
+                dy = ((g + 2 * h_ + i) - (a + 2 * b + c_)) * ratio
+
+                mag2 = dx * dx + dy * dy
+                k = 0
+                while k < 8 and mag2 >= thresh2[k]:
+                    k += 1
+                out[r, c] = k
+else:
+    _horn_classes = None
+
+# Streamlit runs each session in its own thread, and Numba's fallback
+# "workqueue" threading layer aborts the process on concurrent parallel
+# calls; the kernel already uses every core, so serializing costs little
+_KERNEL_LOCK = threading.Lock()
+
+
+# ---------------------------------------------------------
+# Start Numba's thread pool ahead of the first request
+# ---------------------------------------------------------
+def warm_up():
+    if _horn_classes is not None:
+        with _KERNEL_LOCK:
+            _horn_classes(
+                np.zeros((3, 3), dtype=np.float32),
+                1.0,
+                SLOPE_THRESH2,
+                np.empty((3, 3), dtype=np.uint8),
+            )
+
+
+# ---------------------------------------------------------
+# Tiling grid: (core, padded) slice pairs, padded by `overlap`
+# ---------------------------------------------------------
+def generate_tiling_grid(row_off, col_off, height, width, tile_h, tile_w, overlap=1):
+    row_end, col_end = row_off + height, col_off + width
+    tiles = []
+
+    for r0 in range(row_off, row_end, tile_h):
+        r1 = min(r0 + tile_h, row_end)
+        for c0 in range(col_off, col_end, tile_w):
+            c1 = min(c0 + tile_w, col_end)
+            core = (slice(r0, r1), slice(c0, c1))
+            padded = (
+                slice(max(r0 - overlap, row_off), min(r1 + overlap, row_end)),
+                slice(max(c0 - overlap, col_off), min(c1 + overlap, col_end)),
+            )
+            tiles.append((core, padded))
+
+    return tiles
+
+
+# ---------------------------------------------------------
+# Slope classes (uint8, 8° bins), tiled for large rasters
+# ---------------------------------------------------------
+def slope_classes(dem, ewres, nsres):
+    h, w = dem.shape
+    # Gradients are left unscaled; scale the class edges instead
+    thresh2 = SLOPE_THRESH2 * (8 * ewres) ** 2
+
+    # Once compiled (see warm_up) the kernel beats NumPy at every size
+    if _horn_classes is not None:
+        bins = np.empty((h, w), dtype=np.uint8)
+        with _KERNEL_LOCK:
+            _horn_classes(dem, ewres / nsres, thresh2, bins)
+        return bins
+
+    if h * w <= MAX_UNTILED_PIXELS:
+        return classify_gradient2(horn_gradient2(dem, ewres, nsres), thresh2)
+
+    bins = np.empty((h, w), dtype=np.uint8)
+
+    def run_tile(tile):
+        core, padded = tile
+        mag2 = horn_gradient2(dem[padded], ewres, nsres)
+        # Strip the 1-px apron the 3x3 kernel needed
+        inner = (
+            slice(core[0].start - padded[0].start, core[0].stop - padded[0].start),
+            slice(core[1].start - padded[1].start, core[1].stop - padded[1].start),
+        )
+        bins[core] = classify_gradient2(mag2[inner], thresh2)
+
+    # NumPy releases the GIL inside the ufuncs, so threads overlap
+    with ThreadPoolExecutor() as pool:
+        list(pool.map(run_tile, generate_tiling_grid(0, 0, h, w, TILE_SIZE, TILE_SIZE)))
+
+    return bins
 
 
 # ---------------------------------------------------------
 # MAIN SLOPE PROCESSOR (base64 PNG + correct bounds)
 # ---------------------------------------------------------
-def process_slope(geom):
+def process_slope(geom, tolerance=1e-5):
 
-    geom = clean_geometry(geom)
+    geom = clean_geometry(geom, tolerance)
     if geom is None:
-        st.error("Invalid geometry.")
-        return None
+        raise ValueError("Invalid geometry.")
 
-    bbox = safe_bbox(geom)
-    dem_path = download_dem(bbox)
-    if dem_path is None:
-        return None
+    dem_path = download_dem(safe_bbox(geom))
 
-    # ---- CLIP DEM ----
+    # ---- READ DEM + CLIP TO POLYGON (block-aligned window, tile by tile) ----
     try:
-        with rasterio.open(dem_path) as src:
-            dem_img, transform = mask(src, [mapping(geom)], crop=True)
+        # GDAL's default block cache is 5% of RAM *per process*; cap it so
+        # concurrent sessions stay bounded, and let GDAL decode in parallel
+        with rasterio.Env(GDAL_CACHEMAX=64, GDAL_NUM_THREADS="ALL_CPUS"), \
+                rasterio.open(dem_path) as src:
+            aoi_win, read_win = aoi_windows(src, geom.bounds)
+            transform = src.window_transform(read_win)
+            aoi_transform = src.window_transform(aoi_win)
             nodata = src.nodata
+            is_geographic = src.crs is not None and src.crs.is_geographic
+
+            # Tiles are read straight into one float32 array; nodata and the
+            # polygon mask are applied per tile, so no full-size int16 copy,
+            # masked array or boolean mask is ever allocated
+            dem = np.empty((read_win.height, read_win.width), dtype=np.float32)
+            grid = generate_tiling_grid(
+                0, 0, read_win.height, read_win.width, READ_TILE, READ_TILE, overlap=0
+            )
+
+            # AOI window in `dem` coordinates; the block-alignment margin
+            # around it keeps real elevations so edge pixels see true
+            # neighbours, and only pixels inside it are polygon-masked
+            ar0 = aoi_win.row_off - read_win.row_off
+            ac0 = aoi_win.col_off - read_win.col_off
+            ar1, ac1 = ar0 + aoi_win.height, ac0 + aoi_win.width
+
+            # Polygon converted once; tiles wholly inside or outside it
+            # skip rasterization
+            shapes = [mapping(geom)]
+            prepared = prep(geom)
+
+            valid_sum, valid_n = 0.0, 0
+            for (rows, cols), _ in grid:
+                win = Window(
+                    read_win.col_off + cols.start,
+                    read_win.row_off + rows.start,
+                    cols.stop - cols.start,
+                    rows.stop - rows.start,
+                )
+                tile = dem[rows, cols]
+                src.read(1, window=win, out=tile)
+
+                invalid = np.isnan(tile)
+                if nodata is not None:
+                    invalid |= tile == nodata
+
+                # Part of this tile inside the AOI window; the rest is margin
+                th, tw = tile.shape
+                rs0, rs1 = np.clip([ar0 - rows.start, ar1 - rows.start], 0, th)
+                cs0, cs1 = np.clip([ac0 - cols.start, ac1 - cols.start], 0, tw)
+                if rs1 > rs0 and cs1 > cs0:
+                    part = (slice(rs0, rs1), slice(cs0, cs1))
+                    part_shape = (rs1 - rs0, cs1 - cs0)
+                    part_transform = src.window_transform(Window(
+                        win.col_off + cs0, win.row_off + rs0, cs1 - cs0, rs1 - rs0
+                    ))
+                    part_box = box(*array_bounds(*part_shape, part_transform))
+
+                    if not prepared.intersects(part_box):
+                        invalid[part] = True
+                    elif not prepared.contains(part_box):
+                        invalid[part] |= geometry_mask(
+                            shapes, out_shape=part_shape, transform=part_transform
+                        )
+
+                    # Accumulate the fill mean (polygon pixels only) while
+                    # the tile is still in cache
+                    inside = ~invalid[part]
+                    valid_sum += float(tile[part].sum(where=inside, dtype=np.float64))
+                    valid_n += np.count_nonzero(inside)
+
+                tile[invalid] = np.nan
     except Exception as e:
-        st.error(f"DEM clip error: {e}")
-        return None
-
-    dem = dem_img[0].astype("float32")
-
-    if nodata is not None:
-        dem[dem == nodata] = np.nan
+        raise RuntimeError(f"DEM clip error: {e}") from e
 
-    if np.isnan(dem).all():
-        st.error("DEM contains only nodata.")
-        return None
+    if valid_n == 0:
+        raise RuntimeError("DEM contains only nodata.")
 
-    dem[np.isnan(dem)] = np.nanmean(dem)
+    # One in-place sweep instead of isnan/all/nanmean/isnan scans
+    np.nan_to_num(dem, copy=False, nan=np.float32(valid_sum / valid_n))
 
     # -------- SLOPE --------
-    gy, gx = np.gradient(dem)
-    slope = np.degrees(np.arctan(np.hypot(gx, gy)))
+    ewres, nsres = abs(transform.a), abs(transform.e)
+    if is_geographic:
+        # SRTM pixels are in degrees; convert to metres at the AOI latitude
+        lat = np.radians(transform.f + transform.e * dem.shape[0] / 2)
+        ewres *= 111320 * float(np.cos(lat))
+        nsres *= 111320
 
     # -------- CLASSIFY --------
-    classes = np.clip((slope // 8).astype(int), 0, 8)
-
-    COLORS = [
-        (173, 216, 230),  # 0 light blue
-        (144, 238, 144),  # 1 light green
-        (0, 100, 0),      # 2 dark green
-        (255, 255, 102),  # 3 yellow
-        (255, 165, 0),    # 4 orange
-        (255, 0, 0),      # 5 red
-        (139, 0, 0),      # 6 dark red
-        (128, 0, 128),    # 7 purple
-        (0, 0, 0),        # 8 black
-    ]
-
-    h, w = classes.shape
-    rgb = np.zeros((h, w, 3), dtype=np.uint8)
-    for i, c in enumerate(COLORS):
-        rgb[classes == i] = c
+    bins = slope_classes(dem, ewres, nsres)
+
+    # Back from the block-aligned read to the exact AOI window
+    r0 = aoi_win.row_off - read_win.row_off
+    c0 = aoi_win.col_off - read_win.col_off
+    bins = bins[r0:r0 + aoi_win.height, c0:c0 + aoi_win.width]
+    transform = aoi_transform
+    h, w = bins.shape
+
+    # Classes are categorical, so plain striding is a correct downsample
+    step = -(-max(h, w) // PREVIEW_MAX_SIDE)
+    if step > 1:
+        bins = bins[::step, ::step]
+
+    # -------- BASE64 PNG (8-bit palette, one byte per pixel) --------
+    # Encoded once and discarded; zlib level 1 is several times faster than 6
+    # Cropping/striding leaves a strided view; one contiguous copy that
+    # Pillow then wraps without copying again
+    bins = np.ascontiguousarray(bins)
+    img = Image.frombuffer("P", bins.shape[::-1], bins, "raw", "P", 0, 1)
+    img.putpalette(SLOPE_LUT[:, :3].tobytes())
 
-    # -------- BASE64 PNG --------
     buffer = BytesIO()
-    Image.fromarray(rgb).save(buffer, "PNG")
+    img.save(buffer, "PNG", compress_level=1, optimize=False)
     img_b64 = base64.b64encode(buffer.getvalue()).decode()
 
-    # -------- CORRECT MANUAL BOUNDS (FINAL FIX) --------
-    pixel_width = transform.a
-    pixel_height = transform.e  # NEGATIVE
-    origin_x = transform.c
-    origin_y = transform.f
-
-    min_lon = origin_x
-    max_lon = origin_x + pixel_width * w
-
-    max_lat = origin_y
-    min_lat = origin_y + pixel_height * h  # pixel_height is negative
+    # -------- BOUNDS (Leaflet order: [[south, west], [north, east]]) --------
+    west, south, east, north = array_bounds(h, w, transform)
 
     return {
         "data_url": f"data:image/png;base64,{img_b64}",
-        "bounds": [[min_lat, min_lon], [max_lat, max_lon]],
+        "bounds": [[south, west], [north, east]],
     }